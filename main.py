@@ -6,17 +6,160 @@ Purpose: Backup BestCase CLIENTS Directory
 """
 
 import argparse
+import atexit
 import subprocess
 import os
+import stat
 import logging
 import json
 import tempfile
 import datetime
-import boto3
-from botocore.exceptions import ClientError
+import time
+import threading
+import shutil
+import hashlib
+import importlib.util
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from logging.handlers import RotatingFileHandler
 from pathlib import Path
-import psutil
-import requests
+from modules.ami_create import create_ami, get_ec2_client
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+TEMP_DIR = Path(tempfile.gettempdir())
+
+# Size at which the log file is rotated, and the rotated logs to keep
+LOG_MAX_BYTES = 1000000
+LOG_BACKUP_COUNT = 3
+
+# UTC archive timestamps, which sort in chronological order
+TIMESTAMP_FORMAT = "%Y%m%dT%H%M%SZ"
+
+# Every backup object's name starts with this; pruning and expiration touch
+# nothing else in the bucket
+ARCHIVE_PREFIX = "CLIENTS_"
+
+# Backups are written once and rarely read: by default Intelligent-Tiering
+# moves them to cheaper tiers with no retrieval fee or minimum storage
+# duration. The storage_class setting picks another class.
+STORAGE_CLASS = "INTELLIGENT_TIERING"
+STORAGE_CLASSES = (
+    "STANDARD",
+    "STANDARD_IA",
+    "ONEZONE_IA",
+    "INTELLIGENT_TIERING",
+    "GLACIER_IR",
+    "GLACIER",
+    "DEEP_ARCHIVE",
+)
+
+# Defaults for the optional config file keys
+DEFAULT_SETTINGS = {
+    "stream_upload": False,
+    "shard_clients": False,
+    "lifecycle_expiration": False,
+    "compression_level": None,
+    "storage_class": STORAGE_CLASS,
+}
+
+# Days to keep backups for
+RETENTION_DAYS = 7
+
+# IDs of the bucket lifecycle rules managed by ensure_lifecycle_rules
+EXPIRATION_RULE_ID = "bestcase-backup-expiration"
+DELETE_MARKER_RULE_ID = "bestcase-backup-delete-markers"
+
+# Multipart settings for the archive upload; parts larger than the 8 MiB
+# boto3 default keep far more bytes in flight per request.
+MULTIPART_THRESHOLD = 20 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 64 * 1024 * 1024
+
+# Streamed uploads hold every in-flight part in memory, so they use smaller
+# parts: 16 MiB x MAX_CONCURRENCY instead of 64 MiB x MAX_CONCURRENCY.
+# 10,000 parts still allow archives of up to 160 GiB.
+STREAM_CHUNKSIZE = 16 * 1024 * 1024
+# Uploads are network-bound, so use several threads per core
+MAX_CONCURRENCY = min(32, (os.cpu_count() or 1) * 4)
+
+# Upload progress is logged every PROGRESS_STEP bytes
+PROGRESS_STEP = 1024 * 1024 * 1024
+
+# SHA-256 part checksums replace the MD5 pass and are verified by S3
+UPLOAD_EXTRA_ARGS = {
+    "ServerSideEncryption": "AES256",
+    "ChecksumAlgorithm": "SHA256",
+}
+
+# Content types of the uploaded objects by extension. No Content-Encoding
+# is set: the archives are files to download, not bodies for an HTTP
+# client to decompress on the fly.
+CONTENT_TYPES = {
+    ".7z": "application/x-7z-compressed",
+    ".zip": "application/zip",
+    ".tar.xz": "application/x-xz",
+    ".tar.zst": "application/zstd",
+    ".json": "application/json",
+}
+
+# Client folders compressed and uploaded at once in shard mode; each 7z
+# run is itself multithreaded, so a few of them saturate the CPU
+SHARD_WORKERS = min(4, os.cpu_count() or 1)
+
+# urllib3 2.x writes request bodies in 16 KiB chunks, which keeps uploads
+# CPU-bound; the S3 connection pool must cover every transfer thread
+HTTP_BLOCKSIZE = 1024 * 1024
+MAX_POOL_CONNECTIONS = MAX_CONCURRENCY * SHARD_WORKERS
+
+# DeleteObjects accepts at most 1000 keys; a few concurrent batches stay
+# well under S3's 3,500 writes per second per prefix
+DELETE_BATCH_SIZE = 1000
+PRUNE_WORKERS = 8
+
+# Kernel buffer for the 7z pipes on Linux, 1 MiB is the default limit for
+# unprivileged processes
+PIPE_SIZE = 1024 * 1024
+
+# Client files that are already compressed; recompressing them burns CPU
+# for next to no gain, so they are added to the archive in store mode
+STORED_EXTENSIONS = (".pdf", ".png", ".jpg", ".jpeg", ".docx", ".xlsx", ".zip", ".7z")
+
+# 7z switches per --compressor, for .7z archives and for streamed tarballs,
+# with the archive extensions and the default and highest level. zstd is
+# much faster than LZMA at a similar ratio but needs a 7-Zip build with the
+# zstd codec, e.g. 7-Zip ZS. zip deflates in-process with zipfile, needs no
+# 7z at all and streams the same .zip it would write to disk. The archive is
+# deleted once uploaded, so the defaults favour speed over the last few
+# percent of ratio.
+COMPRESSORS = {
+    "lzma": {
+        "archive": [],
+        "stream": ["-txz"],
+        "extension": ".7z",
+        "stream_extension": ".tar.xz",
+        "level": 5,
+        "max_level": 9,
+    },
+    "zstd": {
+        "archive": ["-m0=zstd"],
+        "stream": ["-tzstd"],
+        "extension": ".7z",
+        "stream_extension": ".tar.zst",
+        "level": 3,
+        "max_level": 22,
+    },
+    "zip": {
+        "extension": ".zip",
+        "stream_extension": ".zip",
+        "level": 3,
+        "max_level": 9,
+    },
+}
 
 
 # --------------------------------------------------
@@ -65,16 +208,126 @@ def get_args():
         type=argparse.FileType("r"),
     )
 
+    parser.add_argument(
+        "-z",
+        "--compressor",
+        help="Compression method, overridden by the config file",
+        metavar="str",
+        type=str,
+        required=False,
+        choices=sorted(COMPRESSORS),
+        default="lzma",
+    )
+
     return parser.parse_args()
 
 
 # --------------------------------------------------
-def compress_dir_7z(directory_path, output_file=None):
+@lru_cache(maxsize=None)
+def find_7z():
+    """Returns the absolute path of the 7z executable, looked up on the
+    PATH once, or plain "7z" if it is not there"""
+
+    return shutil.which("7z") or "7z"
+
+
+# --------------------------------------------------
+@lru_cache(maxsize=None)
+def have_awscrt():
+    """Whether the AWS Common Runtime, boto3[crt], is installed"""
+
+    return importlib.util.find_spec("awscrt") is not None
+
+
+# --------------------------------------------------
+def archive_name(extension):
+    """Builds a timestamped archive file name.
+
+    Args:
+        extension (str): The archive extension, e.g. ".7z".
+
+    Returns:
+        str: The file name, e.g. CLIENTS_20230605T010000Z.7z
+    """
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return f"{ARCHIVE_PREFIX}{now.strftime(TIMESTAMP_FORMAT)}{extension}"
+
+
+# --------------------------------------------------
+def remove_archive(output_file):
+    """Deletes a local archive, tolerating one that is already gone.
+
+    Args:
+        output_file (str): The path to the archive.
+
+    Returns:
+        bool: True if the archive no longer exists, False otherwise.
+    """
+
+    try:
+        os.remove(output_file)
+    except FileNotFoundError:
+        pass
+    except OSError as os_error:
+        # e.g. still open in another process on Windows
+        logging.warning("Removing %s failed: %s", output_file, os_error)
+        return False
+    return True
+
+
+# --------------------------------------------------
+def level_switch(compressor, level=None):
+    """Returns the 7z -mx switch for a compressor, at its default level
+    unless one is given"""
+
+    if level is None:
+        level = COMPRESSORS[compressor]["level"]
+    return f"-mx={level}"
+
+
+# --------------------------------------------------
+def find_stored_files(directory_path):
+    """Lists the files under a directory with a STORED_EXTENSIONS extension.
+
+    Args:
+        directory_path (str): The directory to search, recursively.
+
+    Returns:
+        list: The paths of the matching files, relative to directory_path.
+
+    Raises:
+        OSError: If a directory cannot be read.
+    """
+
+    stored_files = []
+    pending = [directory_path]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.name.lower().endswith(STORED_EXTENSIONS):
+                    stored_files.append(os.path.relpath(entry.path, directory_path))
+    return stored_files
+
+
+# --------------------------------------------------
+def compress_dir_7z(
+    directory_path,
+    output_file=None,
+    compressor="lzma",
+    subdir="CLIENTS",
+    level=None,
+):
     """Compresses a directory using 7zip.
 
     Args:
         directory_path (str): The path to the directory to be compressed.
         output_file (str): The path to save the compressed file.
+        compressor (str): The COMPRESSORS entry to compress with.
+        subdir (str): The subdirectory of directory_path to archive.
+        level (int): The 7z compression level, None for the default.
         debug (bool): Whether to print debug messages.
         log_file (str): The path to the log file.
 
@@ -84,61 +337,480 @@ def compress_dir_7z(directory_path, output_file=None):
             str: The path to the compressed file.
     """
 
-    if not os.path.exists(directory_path):
+    # A single stat() answers both checks
+    try:
+        path_stat = os.stat(directory_path)
+    except FileNotFoundError:
         logging.critical("Directory '%s' does not exist.", directory_path)
         return [False, None]
 
-    if not os.path.isdir(directory_path):
+    if not stat.S_ISDIR(path_stat.st_mode):
         logging.critical("Path '%s' is not a directory.", directory_path)
         return [False, None]
 
     # Set default output path to TEMP directory if not provided
     if output_file is None:
-        current_datetime = datetime.datetime.now()
-        current_datetime_iso = current_datetime.isoformat()
-        current_datetime_iso_modified = current_datetime_iso.replace(":", "_")
-        temp_dir = tempfile.gettempdir()
-        output_file = temp_dir + "\\CLIENTS_" + current_datetime_iso_modified + ".7z"
+        output_file = str(TEMP_DIR / archive_name(".7z"))
+
+    # Don't leave a multi-GB partial archive behind if anything fails
+    atexit.register(remove_archive, output_file)
 
+    # 7z needs the trailing slash
+    clients_path = str(Path(directory_path) / subdir) + os.sep
     try:
-        # test if 7z is installed
-        subprocess.run(["7z"], stdout=subprocess.DEVNULL, check=True)
-        logging.info("7z is installed.")
+        subprocess.run(
+            [
+                find_7z(),
+                "a",  # Add files to archive
+                output_file,
+                clients_path,
+                "-r",  # Recurse subdirectories
+                *COMPRESSORS[compressor]["archive"],  # Set compression method
+                level_switch(compressor, level),  # Set compression level
+                "-mmt=on",  # Use multithreading
+                "-ssw",  # Include files open for writing
+                *[f"-xr!*{ext}" for ext in STORED_EXTENSIONS],
+            ],
+            check=True,
+        )
     except FileNotFoundError:
         logging.critical("7z is not installed.")
         return [False, None]
-    except subprocess.CalledProcessError:
-        logging.critical("7z is not installed or is not working.")
+    except subprocess.CalledProcessError as called_error:
+        logging.critical("Compression failed: %s", called_error)
         return [False, None]
 
-    clients_path = directory_path + "\\CLIENTS\\"  # 7z needs the trailing slash
+    # Append the already-compressed files uncompressed. Updating the
+    # archive makes 7z rewrite it, so this pass only runs when there is
+    # something to store, and only for the files that exist
+    try:
+        stored_files = find_stored_files(clients_path)
+    except OSError as os_error:
+        logging.critical("Listing compressed files failed: %s", os_error)
+        return [False, None]
+    if not stored_files:
+        return [True, output_file]
+
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", suffix=".txt", dir=TEMP_DIR, delete=False
+    ) as list_file:
+        # Listed from directory_path, so they land under subdir like the
+        # files of the first pass
+        list_file.write("\n".join(os.path.join(subdir, rel) for rel in stored_files))
     try:
         subprocess.run(
             [
-                "7z",
+                find_7z(),
                 "a",  # Add files to archive
                 output_file,
-                clients_path,
-                "-r",  # Recurse subdirectories
-                "-mx=9",  # Set maximum compression level
-                "-mmt=on",  # Use multithreading
+                f"@{list_file.name}",  # Files listed relative to directory_path
+                "-scsUTF-8",  # List file encoding
+                "-mx=0",  # Store without compression
+                "-ssw",  # Include files open for writing
             ],
+            cwd=directory_path,
             check=True,
         )
-        return [True, output_file]
     except subprocess.CalledProcessError as called_error:
-        logging.critical("Compression failed: %s", called_error)
+        # Any warning, e.g. a file that could not be opened, means a
+        # missing file, so it fails the backup like the first pass does
+        logging.critical("Storing compressed files failed: %s", called_error)
         return [False, None]
+    finally:
+        remove_archive(list_file.name)
+
+    return [True, output_file]
 
 
 # --------------------------------------------------
-def send_backup(output_file, s3_bucket, use_boto=False):
+def enlarge_pipe(pipe):
+    """Grows a pipe's kernel buffer to PIPE_SIZE where supported (Linux),
+    so both ends move data in fewer, larger reads and writes"""
+
+    if fcntl is None or not hasattr(fcntl, "F_SETPIPE_SZ"):
+        return
+    try:
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+    except OSError as os_error:
+        logging.debug("Could not enlarge pipe: %s", os_error)
+
+
+# --------------------------------------------------
+def stream_dir_7z(directory_path, compressor="lzma", level=None):
+    """Compresses a directory using 7zip, streaming the archive to stdout.
+
+    7zip can only write stream formats to stdout, so the directory is
+    packed as a tar stream and piped through a second 7z process that
+    compresses it.
+
+    Args:
+        directory_path (str): The path to the directory to be compressed.
+        compressor (str): The COMPRESSORS entry to compress with.
+        level (int): The 7z compression level, None for the default.
+
+    Returns:
+        list: The 7z processes of the pipeline, the stdout of the last one
+            carrying the compressed archive, or None if 7z could not start.
+    """
+
+    if not os.path.isdir(directory_path):
+        logging.critical("Path '%s' is not a directory.", directory_path)
+        return None
+
+    # 7z needs the trailing slash
+    clients_path = str(Path(directory_path) / "CLIENTS") + os.sep
+    seven_zip = find_7z()
+    try:
+        tar_proc = subprocess.Popen(
+            [
+                seven_zip,
+                "a",  # Add files to archive
+                "-ttar",  # Pack as a tar stream
+                "-so",  # Write the archive to stdout
+                "CLIENTS.tar",
+                clients_path,
+                "-r",  # Recurse subdirectories
+                "-ssw",  # Include files open for writing
+            ],
+            stdout=subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        logging.critical("7z is not installed.")
+        return None
+
+    xz_proc = subprocess.Popen(
+        [
+            seven_zip,
+            "a",  # Add files to archive
+            "-si",  # Read the tar stream from stdin
+            "-so",  # Write the archive to stdout
+            "CLIENTS" + COMPRESSORS[compressor]["stream_extension"],
+            *COMPRESSORS[compressor]["stream"],  # Stream type
+            level_switch(compressor, level),  # Set compression level
+            "-mmt=on",  # Use multithreading
+        ],
+        stdin=tar_proc.stdout,
+        stdout=subprocess.PIPE,
+    )
+    enlarge_pipe(tar_proc.stdout)
+    enlarge_pipe(xz_proc.stdout)
+    tar_proc.stdout.close()  # Let tar_proc see a broken pipe if xz_proc dies
+    return [tar_proc, xz_proc]
+
+
+# --------------------------------------------------
+def write_zip(directory_path, out, subdir="CLIENTS", level=None):
+    """Writes a zip archive of a directory to a file object.
+
+    Already-compressed files are stored, everything else deflated. zlib
+    releases the GIL while deflating, so a streamed archive is compressed
+    while the upload threads send the previous parts.
+
+    Args:
+        directory_path (str): The path to the directory holding subdir.
+        out (file): The binary file object to write to, seekable or not.
+        subdir (str): The subdirectory of directory_path to archive.
+        level (int): The deflate level, None for the default.
+
+    Raises:
+        OSError: If a directory or file cannot be read.
+    """
+
+    def walk_error(os_error):
+        # A directory os.walk cannot read would silently go missing
+        raise os_error
+
+    if level is None:
+        level = COMPRESSORS["zip"]["level"]
+    # Files older than 1980, which zip cannot date, get 1980-01-01 instead
+    # of failing the backup
+    with zipfile.ZipFile(
+        out,
+        "w",
+        compression=zipfile.ZIP_DEFLATED,
+        compresslevel=level,
+        strict_timestamps=False,
+    ) as archive:
+        for dir_path, _, file_names in os.walk(
+            Path(directory_path) / subdir, onerror=walk_error
+        ):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                stored = file_name.lower().endswith(STORED_EXTENSIONS)
+                archive.write(
+                    file_path,
+                    os.path.relpath(file_path, directory_path),
+                    compress_type=zipfile.ZIP_STORED if stored else None,
+                )
+
+
+# --------------------------------------------------
+def compress_dir_zip(directory_path, output_file=None, subdir="CLIENTS", level=None):
+    """Compresses a directory into a zip archive, in-process.
+
+    Args:
+        directory_path (str): The path to the directory to be compressed.
+        output_file (str): The path to save the compressed file.
+        subdir (str): The subdirectory of directory_path to archive.
+        level (int): The deflate level, None for the default.
+
+    Returns:
+        a list comprising a
+            bool: True if compression was successful, False otherwise.
+            str: The path to the compressed file.
+    """
+
+    # os.walk yields nothing for a missing subdir, which would upload an
+    # empty archive
+    subdir_path = Path(directory_path) / subdir
+    if not os.path.isdir(subdir_path):
+        logging.critical("Path '%s' is not a directory.", subdir_path)
+        return [False, None]
+
+    if output_file is None:
+        output_file = str(TEMP_DIR / archive_name(".zip"))
+
+    # Don't leave a multi-GB partial archive behind if anything fails
+    atexit.register(remove_archive, output_file)
+
+    try:
+        write_zip(directory_path, output_file, subdir=subdir, level=level)
+    except OSError as os_error:
+        logging.critical("Compression failed: %s", os_error)
+        return [False, None]
+
+    return [True, output_file]
+
+
+# --------------------------------------------------
+class ZipStream:
+    """Writes a zip archive of a directory into a pipe on a thread.
+
+    Stands in for the 7z processes of stream_dir_7z: stdout carries the
+    archive, kill() stops the writer and wait() returns its exit code.
+    """
+
+    def __init__(self, directory_path, subdir="CLIENTS", level=None):
+        read_fd, write_fd = os.pipe()
+        self.stdout = os.fdopen(read_fd, "rb")
+        self._sink = os.fdopen(write_fd, "wb", buffering=PIPE_SIZE)
+        enlarge_pipe(self.stdout)
+        self.returncode = None
+        self._thread = threading.Thread(
+            target=self._write, args=(directory_path, subdir, level), daemon=True
+        )
+        self._thread.start()
+
+    def _write(self, directory_path, subdir, level):
+        try:
+            with self._sink:
+                write_zip(directory_path, self._sink, subdir=subdir, level=level)
+            self.returncode = 0
+        except (OSError, ValueError) as error:
+            logging.critical("Compression failed: %s", error)
+            self.returncode = 1
+
+    def kill(self):
+        # The writer fails on its next write to the broken pipe
+        self.stdout.close()
+
+    def wait(self):
+        self._thread.join()
+        # No exit code means the writer died on an unexpected error, which
+        # still ended the stream as if the archive were complete
+        return 1 if self.returncode is None else self.returncode
+
+
+# --------------------------------------------------
+def compress_dir(
+    directory_path,
+    output_file=None,
+    compressor="lzma",
+    subdir="CLIENTS",
+    level=None,
+):
+    """Compresses a directory with 7zip or, for zip, in-process.
+
+    Args:
+        directory_path (str): The path to the directory to be compressed.
+        output_file (str): The path to save the compressed file.
+        compressor (str): The COMPRESSORS entry to compress with.
+        subdir (str): The subdirectory of directory_path to archive.
+        level (int): The compression level, None for the default.
+
+    Returns:
+        a list comprising a
+            bool: True if compression was successful, False otherwise.
+            str: The path to the compressed file.
+    """
+
+    if compressor == "zip":
+        return compress_dir_zip(
+            directory_path, output_file=output_file, subdir=subdir, level=level
+        )
+    return compress_dir_7z(
+        directory_path,
+        output_file=output_file,
+        compressor=compressor,
+        subdir=subdir,
+        level=level,
+    )
+
+
+# --------------------------------------------------
+def stream_dir(directory_path, compressor="lzma", level=None):
+    """Compresses a directory to a stream with 7zip or, for zip, in-process.
+
+    Args:
+        directory_path (str): The path to the directory to be compressed.
+        compressor (str): The COMPRESSORS entry to compress with.
+        level (int): The compression level, None for the default.
+
+    Returns:
+        list: The pipeline as returned by stream_dir_7z, or None if
+            compression could not start.
+    """
+
+    if compressor == "zip":
+        clients_path = Path(directory_path) / "CLIENTS"
+        if not os.path.isdir(clients_path):
+            logging.critical("Path '%s' is not a directory.", clients_path)
+            return None
+        return [ZipStream(directory_path, level=level)]
+    return stream_dir_7z(directory_path, compressor, level)
+
+
+# --------------------------------------------------
+def make_transfer_config(chunksize=MULTIPART_CHUNKSIZE):
+    """Builds the multipart TransferConfig used for backup uploads, with
+    parts of chunksize bytes"""
+
+    from boto3.s3 import constants
+    from boto3.s3.transfer import TransferConfig
+
+    # The CRT transfer client splits and sends parts on native threads,
+    # outside the GIL; without awscrt boto3's classic threads are used.
+    # boto3 1.42 is the first to honour "crt" (older releases reject or
+    # ignore it), so it is only asked for where that constant exists
+    options = {}
+    if have_awscrt() and hasattr(constants, "CRT_TRANSFER_CLIENT"):
+        options["preferred_transfer_client"] = constants.CRT_TRANSFER_CLIENT
+    return TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD,
+        multipart_chunksize=chunksize,
+        max_concurrency=MAX_CONCURRENCY,
+        use_threads=True,
+        **options,
+    )
+
+
+# --------------------------------------------------
+@lru_cache(maxsize=None)
+def get_session():
+    """Returns the shared Boto3 session every client is created from.
+
+    Credentials and service models are resolved once for all clients, and
+    unlike the implicit default session it is set up before any worker
+    thread asks for a client.
+    """
+
+    import boto3
+
+    return boto3.session.Session()
+
+
+# --------------------------------------------------
+@lru_cache(maxsize=None)
+def get_s3_client():
+    """Returns the shared Boto3 S3 client, tuned for large uploads.
+
+    Built on first use and reused afterwards; clients are thread-safe, and
+    creating one costs endpoint resolution and credential discovery.
+    """
+
+    from botocore.config import Config
+    from urllib3 import connection
+
+    # botocore's connections build on urllib3's, which pass their own
+    # keyword-only blocksize down to http.client. urllib3 1.x has none and
+    # keeps http.client's 8 KiB.
+    for connection_class in (connection.HTTPConnection, connection.HTTPSConnection):
+        kwdefaults = connection_class.__init__.__kwdefaults__ or {}
+        if "blocksize" in kwdefaults:
+            kwdefaults["blocksize"] = HTTP_BLOCKSIZE
+    return get_session().client(
+        "s3",
+        config=Config(
+            max_pool_connections=MAX_POOL_CONNECTIONS,
+            tcp_keepalive=True,
+            retries={"max_attempts": 10, "mode": "adaptive"},
+        ),
+    )
+
+
+# --------------------------------------------------
+@lru_cache(maxsize=None)
+def get_sns_client():
+    """Returns the shared Boto3 SNS client"""
+
+    return get_session().client("sns")
+
+
+# --------------------------------------------------
+def parse_s3_url(s3_url):
+    """Splits an S3 URL into its bucket name and key prefix.
+
+    Args:
+        s3_url (str): The S3 URL, e.g. s3://my-bestcase-backup/daily.
+
+    Returns:
+        a list comprising a
+            str: The bucket name.
+            str: The key prefix, either empty or ending in a slash.
+    """
+
+    bucket, _, prefix = s3_url.replace("s3://", "", 1).partition("/")
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    return [bucket, prefix]
+
+
+# --------------------------------------------------
+def upload_args(key, storage_class=STORAGE_CLASS):
+    """Builds the ExtraArgs for uploading a backup object.
+
+    Args:
+        key (str): The object's key, which gives its content type.
+        storage_class (str): The S3 storage class to store it in.
+
+    Returns:
+        dict: The ExtraArgs for upload_file, upload_fileobj or put_object.
+    """
+
+    content_type = next(
+        (
+            content_type
+            for extension, content_type in CONTENT_TYPES.items()
+            if key.endswith(extension)
+        ),
+        "application/octet-stream",
+    )
+    return {
+        **UPLOAD_EXTRA_ARGS,
+        "StorageClass": storage_class,
+        "ContentType": content_type,
+    }
+
+
+# --------------------------------------------------
+def send_backup(output_file, s3_bucket, file_name=None, storage_class=STORAGE_CLASS):
     """Sends a backup file to an S3 bucket.
 
     Args:
         output_path (str): The path to the backup file.
         s3_bucket (str): The name of the S3 bucket to send the backup to.
-        use_boto (bool): Whether to use the Boto3 library (True) or the AWS CLI (False)
+        file_name (str): The object name, defaults to the backup file's name.
+        storage_class (str): The S3 storage class to store the backup in.
         debug (bool): Whether to print debug messages.
         log_file (str): The path to the log file.
 
@@ -146,43 +818,271 @@ def send_backup(output_file, s3_bucket, use_boto=False):
         bool: True if the backup was sent successfully, False otherwise.
     """
 
-    if not os.path.exists(output_file):
+    from boto3.exceptions import S3UploadFailedError
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    # A single stat() answers both checks
+    try:
+        path_stat = os.stat(output_file)
+    except FileNotFoundError:
         logging.error("File '%s' does not exist.", output_file)
         return False
 
-    if not os.path.isfile(output_file):
+    if not stat.S_ISREG(path_stat.st_mode):
         logging.error("Path '%s' is not a file.", output_file)
         return False
 
-    if use_boto:
-        try:
-            s3_bucket = s3_bucket.replace("s3://", "")
-            logging.info("Sending %s backup via Boto3.", output_file)
-            output_file_name = Path(output_file).name
-            s3_client = boto3.client("s3")
-            response = s3_client.upload_file(output_file, s3_bucket, output_file_name)
-            logging.info("Response: %s", response)
-            return True
-        except ClientError as s3_error:
-            logging.critical("Sending backup via Boto3 failed: %s", s3_error)
-            return False
-    else:
+    [bucket, prefix] = parse_s3_url(s3_bucket)
+    key = prefix + (file_name or Path(output_file).name)
+
+    try:
+        logging.info("Sending %s backup via Boto3 to %s.", output_file, key)
+        get_s3_client().upload_file(
+            output_file,
+            bucket,
+            key,
+            ExtraArgs=upload_args(key, storage_class),
+            Config=make_transfer_config(),
+            Callback=UploadProgress(key),
+        )
+        return True
+    except (BotoCoreError, ClientError, S3UploadFailedError) as s3_error:
+        logging.critical("Sending backup via Boto3 failed: %s", s3_error)
+        return False
+
+
+# --------------------------------------------------
+class UploadProgress:
+    """Upload Callback that logs the bytes sent every PROGRESS_STEP.
+
+    boto3 calls it from every transfer thread, hence the lock.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.sent = 0
+        self.next_report = PROGRESS_STEP
+        self.lock = threading.Lock()
+
+    def __call__(self, bytes_sent):
+        with self.lock:
+            self.sent += bytes_sent
+            if self.sent < self.next_report:
+                return
+            self.next_report += PROGRESS_STEP
+            sent = self.sent
+        logging.info("Uploaded %d MiB of %s.", sent // (1024 * 1024), self.key)
+
+
+# --------------------------------------------------
+class HashingReader:
+    """Wraps a binary stream, hashing the bytes as they are read"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        """Reads from the stream and adds the data to the digest"""
+
+        data = self.stream.read(size)
+        self.sha256.update(data)
+        return data
+
+
+# --------------------------------------------------
+def stream_backup(procs, s3_bucket, file_name, storage_class=STORAGE_CLASS):
+    """Streams a backup from a 7z pipeline to an S3 bucket via Boto3.
+
+    Parts are uploaded while 7z is still compressing, so no archive is
+    ever written to disk.
+
+    Args:
+        procs (list): The 7z processes returned by stream_dir_7z.
+        s3_bucket (str): The name of the S3 bucket to send the backup to.
+        file_name (str): The object name to store the backup under.
+        storage_class (str): The S3 storage class to store the backup in.
+
+    Returns:
+        bool: True if the backup was sent successfully, False otherwise.
+    """
+
+    from boto3.exceptions import S3UploadFailedError
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    [bucket, prefix] = parse_s3_url(s3_bucket)
+    key = prefix + file_name
+    s3_client = get_s3_client()
+    archive = HashingReader(procs[-1].stdout)
+    uploaded = False
+    try:
+        logging.info("Streaming backup to %s.", key)
+        s3_client.upload_fileobj(
+            archive,
+            bucket,
+            key,
+            ExtraArgs=upload_args(key, storage_class),
+            Config=make_transfer_config(chunksize=STREAM_CHUNKSIZE),
+            Callback=UploadProgress(key),
+        )
+        uploaded = True
+    except (BotoCoreError, ClientError, S3UploadFailedError) as s3_error:
+        logging.critical("Streaming backup via Boto3 failed: %s", s3_error)
+        return False
+    finally:
+        # Nothing reads the pipe once the upload stops, so a writer left
+        # running would block on it forever
+        if not uploaded:
+            for proc in procs:
+                proc.kill()
+        return_codes = [proc.wait() for proc in procs]
+
+    # A failed 7z run still ends the stream, leaving a truncated object
+    if any(return_codes):
+        logging.critical("Compression failed with exit codes %s.", return_codes)
         try:
-            subprocess.run(["aws", "s3", "cp", output_file, s3_bucket], check=True)
-            return True
-        except subprocess.CalledProcessError as called_error:
-            logging.critical("Sending backup via AWS CLI failed: %s", called_error)
-            return False
+            s3_client.delete_object(Bucket=bucket, Key=key)
+        except ClientError as client_error:
+            logging.critical("Deleting truncated backup failed: %s", client_error)
+        return False
+
+    logging.info("SHA-256 of %s: %s", key, archive.sha256.hexdigest())
+    return True
 
 
 # --------------------------------------------------
-def send_msg_sns(message, recipient, use_boto=False, subject=None):
-    """Sends a message to an SNS topic
+def send_shard(
+    clients_dir,
+    client,
+    s3_bucket,
+    shard_dir,
+    compressor,
+    level=None,
+    storage_class=STORAGE_CLASS,
+):
+    """Compresses one client folder and sends it to an S3 bucket.
 
-    Uses the Boto3 library if available, else sends the message via AWS CLI.
+    Args:
+        clients_dir (str): The path to the CLIENTS directory.
+        client (str): The name of the client folder.
+        s3_bucket (str): The name of the S3 bucket to send the backup to.
+        shard_dir (str): The S3 folder holding this run's shards.
+        compressor (str): The COMPRESSORS entry to compress with.
+        level (int): The 7z compression level, None for the default.
+        storage_class (str): The S3 storage class to store the shard in.
+
+    Returns:
+        str: The shard's object name, or None if it failed.
+    """
+
+    extension = COMPRESSORS[compressor]["extension"]
+    output_file = str(TEMP_DIR / f"{shard_dir}_{client}{extension}")
+    [compress_success, output_file] = compress_dir(
+        clients_dir,
+        output_file=output_file,
+        compressor=compressor,
+        subdir=client,
+        level=level,
+    )
+    if not compress_success:
+        logging.error("Compressing client folder '%s' failed.", client)
+        return None
+
+    file_name = shard_dir + "/" + client + extension
+    try:
+        if not send_backup(
+            output_file, s3_bucket, file_name=file_name, storage_class=storage_class
+        ):
+            return None
+        return file_name
+    finally:
+        remove_archive(output_file)
+
+
+# --------------------------------------------------
+def send_shards(
+    directory_path, s3_bucket, compressor, level=None, storage_class=STORAGE_CLASS
+):
+    """Backs up each client folder as its own archive, in parallel.
+
+    The archives are stored in one S3 folder per run, next to a
+    manifest.json listing them.
+
+    Args:
+        directory_path (str): The path to the BestCase directory.
+        s3_bucket (str): The name of the S3 bucket to send the backup to.
+        compressor (str): The COMPRESSORS entry to compress with.
+        level (int): The 7z compression level, None for the default.
+        storage_class (str): The S3 storage class to store the shards in.
+
+    Returns:
+        bool: True if every shard was sent successfully, False otherwise,
+            including when CLIENTS is missing, unreadable or empty, or None
+            if CLIENTS holds loose files and cannot be sharded.
+    """
+
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    clients_dir = str(Path(directory_path) / "CLIENTS")
+    try:
+        with os.scandir(clients_dir) as entries:
+            entries = [(entry.name, entry.is_dir()) for entry in entries]
+    except OSError as os_error:
+        logging.critical("Compression failed: %s", os_error)
+        return False
+    if not entries:
+        logging.critical("Compression failed: '%s' is empty.", clients_dir)
+        return False
+    if not all(is_dir for _, is_dir in entries):
+        logging.warning("CLIENTS holds loose files, sending a single archive.")
+        return None
+    clients = sorted(name for name, _ in entries)
+
+    shard_dir = archive_name("")
+    get_s3_client()  # Create the shared client before the workers race for it
+    with ThreadPoolExecutor(max_workers=SHARD_WORKERS) as executor:
+        shards = list(
+            executor.map(
+                lambda client: send_shard(
+                    clients_dir,
+                    client,
+                    s3_bucket,
+                    shard_dir,
+                    compressor,
+                    level,
+                    storage_class,
+                ),
+                clients,
+            )
+        )
+
+    if None in shards:
+        logging.critical("%d of %d shards failed.", shards.count(None), len(shards))
+        return False
+
+    [bucket, prefix] = parse_s3_url(s3_bucket)
+    manifest = {"created": shard_dir, "shards": shards}
+    manifest_key = prefix + shard_dir + "/manifest.json"
+    try:
+        # The manifest keeps the default class, so it stays readable without
+        # a restore from the Glacier classes
+        get_s3_client().put_object(
+            Bucket=bucket,
+            Key=manifest_key,
+            Body=json.dumps(manifest, indent=4).encode("utf-8"),
+            **upload_args(manifest_key),
+        )
+    except (BotoCoreError, ClientError) as aws_error:
+        logging.critical("Sending shard manifest failed: %s", aws_error)
+        return False
+    return True
+
+
+# --------------------------------------------------
+def send_msg_sns(message, recipient, subject=None):
+    """Sends a message to an SNS topic
 
     Args:
-        use_boto (bool): Whether to use the Boto3 library (True) or the AWS CLI (False)
         message (str): The message to send.
         subject (str): The subject line.
         recipient (str): The SNS topic ARN to send the message to.
@@ -191,139 +1091,299 @@ def send_msg_sns(message, recipient, use_boto=False, subject=None):
         bool: True if sending to the SNS topic was sent successfully, False otherwise.
     """
 
+    from botocore.exceptions import ClientError
+
     if subject is None:
         subject = "Unknown error, please check logs."
 
-    if use_boto:
-        try:
-            sns = boto3.client("sns")
-            sns.publish(TopicArn=recipient, Message=message, Subject=subject)
-            return True
-        except ClientError as client_error:
-            logging.critical(
-                "Sending message via Boto3 to SNS topic failed: %s", client_error
-            )
-            return False
-    else:
-        try:
-            subprocess.run(
-                [
-                    "aws",
-                    "sns",
-                    "publish",
-                    "--topic-arn",
-                    recipient,
-                    "--message",
-                    message,
-                    "--subject",
-                    subject,
-                ],
-                check=True,
-            )
-            return True
-        except subprocess.CalledProcessError as called_error:
-            logging.critical(
-                "Sending message via AWS CLI to SNS topic failed: %s", called_error
-            )
-            return False
+    try:
+        get_sns_client().publish(TopicArn=recipient, Message=message, Subject=subject)
+        return True
+    except ClientError as client_error:
+        logging.critical(
+            "Sending message via Boto3 to SNS topic failed: %s", client_error
+        )
+        return False
+
+
+# --------------------------------------------------
+def delete_objects_batch(bucket, keys):
+    """Deletes up to DELETE_BATCH_SIZE objects with a single request.
+
+    Args:
+        bucket (str): The name of the S3 bucket.
+        keys (list): The keys of the objects to delete.
+
+    Returns:
+        dict: The DeleteObjects response, listing only the failed keys.
+    """
+
+    return get_s3_client().delete_objects(
+        Bucket=bucket,
+        Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+    )
+
+
+# --------------------------------------------------
+def list_expired_backups(s3_bucket, days=7):
+    """Lists the backups in an S3 bucket that are older than days.
+
+    Args:
+        s3_bucket (str): The name of the S3 bucket holding the backups.
+        days (int): The number of days to keep backups for.
+
+    Returns:
+        list: The keys of the expired backups.
+    """
+
+    [bucket, prefix] = parse_s3_url(s3_bucket)
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+        days=days
+    )
+    # Keys carry their UTC creation time, so the name alone tells the age of
+    # a backup. Older ISO-style names sort before any cutoff key and are
+    # judged by LastModified alone.
+    cutoff_key = prefix + ARCHIVE_PREFIX + cutoff.strftime(TIMESTAMP_FORMAT)
+
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+    expired_keys = []
+    pages = paginator.paginate(Bucket=bucket, Prefix=prefix + ARCHIVE_PREFIX)
+    for page in pages:
+        objects = page.get("Contents", [])
+        for obj in objects:
+            if obj["Key"] < cutoff_key and obj["LastModified"] < cutoff:
+                logging.debug("Pruning %s", obj["Key"])
+                expired_keys.append(obj["Key"])
+        # Keys come back in ascending order, so every later page is newer
+        # than the cutoff
+        if objects and objects[-1]["Key"] >= cutoff_key:
+            break
+    return expired_keys
 
 
 # --------------------------------------------------
-def prune_backups(s3_bucket, days=7, use_boto=False):
+def prune_backups(s3_bucket, days=7, expired_keys=None):
     """Prunes old backups from an S3 bucket.
 
     Args:
         s3_bucket (str): The name of the S3 bucket to prune.
         days (int): The number of days to keep backups for.
-        use_boto (bool): Whether to use the Boto3 library (True) or the AWS CLI (False)
-        debug (bool): Whether to print debug messages.
-        log_file (str): The path to the log file.
+        expired_keys (list): The backups to delete as listed by
+            list_expired_backups, listed here if None.
 
     Returns:
         bool: True if pruning was successful, False otherwise.
     """
 
-    if use_boto:
-        try:
-            s3_client = boto3.resource("s3")
-            s3_bucket = s3_bucket.replace("s3://", "")
-            bucket = s3_client.Bucket(s3_bucket)
-            for obj in bucket.objects.all():
-                if obj.last_modified < datetime.datetime.now(
-                    datetime.timezone.utc
-                ) - datetime.timedelta(days=days):
-                    print(obj.key)
-                    obj.delete()
-            return True
-        except ClientError as client_error:
-            logging.critical("Pruning via Boto3 failed: %s", client_error)
-            return False
-    else:
-        try:
-            # create list of backups to delete
-            # backups_to_keep = []
-            # bucket_name = s3_bucket.replace("s3://", "")
-            command = f"aws s3 ls {s3_bucket} --recursive"
-            output = subprocess.check_output(command, shell=True).decode("utf-8")
-            objects = []
-
-            # Process the output
-            lines = output.strip().split("\n")
-            for line in lines:
-                parts = line.split()
-                if len(parts) > 3:
-                    item = [parts[0], parts[2]]
-                    objects.append(item)
-
-            subprocess.run(
-                [
-                    "aws",
-                    "s3",
-                    "rm",
-                    s3_bucket,
-                    "--recursive",
-                    "--exclude",
-                    "*",
-                    "--include",
-                    f"*{days}*.7z",
-                ],
-                check=True,
+    from botocore.exceptions import ClientError
+
+    [bucket, _] = parse_s3_url(s3_bucket)
+    try:
+        if expired_keys is None:
+            expired_keys = list_expired_backups(s3_bucket, days=days)
+
+        batches = [
+            expired_keys[start : start + DELETE_BATCH_SIZE]
+            for start in range(0, len(expired_keys), DELETE_BATCH_SIZE)
+        ]
+        with ThreadPoolExecutor(max_workers=PRUNE_WORKERS) as executor:
+            responses = executor.map(
+                lambda batch: delete_objects_batch(bucket, batch),
+                batches,
             )
-            return True
-        except subprocess.CalledProcessError as called_error:
-            logging.critical("Pruning via AWS CLI failed: %s", called_error)
+            pruned = len(expired_keys)
+            for response in responses:
+                for error in response.get("Errors", []):
+                    pruned -= 1
+                    logging.error(
+                        "Pruning %s failed: %s", error["Key"], error["Message"]
+                    )
+        logging.info("Pruned %d backups.", pruned)
+        return True
+    except ClientError as client_error:
+        logging.critical("Pruning via Boto3 failed: %s", client_error)
+        return False
+
+
+# --------------------------------------------------
+def ensure_lifecycle_rules(s3_bucket, days=7):
+    """Makes S3 expire old backups itself, so no pruning is needed.
+
+    Adds or updates this program's lifecycle rules and keeps any other
+    rules on the bucket. Expired multipart uploads, e.g. from an
+    interrupted streamed backup, are aborted. On versioned buckets
+    expiring only hides a backup behind a delete marker, so the version
+    it leaves is deleted a day later and the then bare marker removed.
+
+    Args:
+        s3_bucket (str): The name of the S3 bucket holding the backups.
+        days (int): The number of days to keep backups for.
+
+    Returns:
+        bool: True if the rules are in place, False otherwise.
+    """
+
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    [bucket, prefix] = parse_s3_url(s3_bucket)
+    rules = [
+        {
+            "ID": EXPIRATION_RULE_ID,
+            "Filter": {"Prefix": prefix + ARCHIVE_PREFIX},
+            "Status": "Enabled",
+            "Expiration": {"Days": days},
+            "NoncurrentVersionExpiration": {"NoncurrentDays": 1},
+            "AbortIncompleteMultipartUpload": {"DaysAfterInitiation": 1},
+        },
+        {
+            "ID": DELETE_MARKER_RULE_ID,
+            "Filter": {"Prefix": prefix + ARCHIVE_PREFIX},
+            "Status": "Enabled",
+            "Expiration": {"ExpiredObjectDeleteMarker": True},
+        },
+    ]
+
+    try:
+        s3_client = get_s3_client()
+        existing = s3_client.get_bucket_lifecycle_configuration(Bucket=bucket)[
+            "Rules"
+        ]
+    except BotoCoreError as aws_error:
+        logging.critical("Reading lifecycle rules failed: %s", aws_error)
+        return False
+    except ClientError as client_error:
+        if client_error.response["Error"]["Code"] != "NoSuchLifecycleConfiguration":
+            logging.critical("Reading lifecycle rules failed: %s", client_error)
             return False
+        existing = []
+
+    if all(rule in existing for rule in rules):
+        return True
+
+    ours = (EXPIRATION_RULE_ID, DELETE_MARKER_RULE_ID)
+    others = [rule for rule in existing if rule.get("ID") not in ours]
+    try:
+        s3_client.put_bucket_lifecycle_configuration(
+            Bucket=bucket, LifecycleConfiguration={"Rules": others + rules}
+        )
+    except (BotoCoreError, ClientError) as aws_error:
+        logging.critical("Setting lifecycle rules failed: %s", aws_error)
+        return False
+    logging.info("Lifecycle rules set to expire backups after %d days.", days)
+    return True
 
 
 # --------------------------------------------------
 def close_processes_by_name(process_name):
+    """Kills every process with the given executable name.
+
+    On Windows taskkill matches the name itself, which beats opening and
+    querying every process on the system through psutil.
+
+    Args:
+        process_name (str): The executable name, e.g. WinBFS.EXE.
+    """
+
+    if os.name == "nt":
+        # Exit code 128 means no process matched
+        subprocess.run(
+            ["taskkill", "/F", "/T", "/IM", process_name],
+            check=False,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return
+
+    import psutil
+
     for process in psutil.process_iter(['name']):
         if process.info['name'] == process_name:
             process.kill()
 
 
 # --------------------------------------------------
-def create_ami():
-    """Create an AMI of the current EC2 instance"""
+@contextmanager
+def ami_alongside(enabled):
+    """Creates an AMI of the current EC2 instance on a worker thread while
+    the with block runs, and waits for it when the block is left.
 
-    try:
-        today_date = datetime.date.today().isoformat()
-        instance_id = requests.get(
-            "http://169.254.169.254/latest/meta-data/instance-id").text
-        logging.info("Instance ID: %s", instance_id)
-        ec2_client = boto3.client("ec2")
-        response = ec2_client.create_image(
-            InstanceId=instance_id,
-            Name="BestCaseInstance-" + today_date,
-            Description="BestCaseInstance-" + today_date,
-            NoReboot=False,
+    Args:
+        enabled (bool): Whether to create an AMI at all.
+    """
+
+    if not enabled:
+        yield
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # A reboot would kill the running backup
+        ami_future = executor.submit(
+            create_ami, no_reboot=True, ec2_client=get_ec2_client(get_session())
         )
-        logging.info("Response: %s", response)
-        return True
-    except ClientError as client_error:
-        logging.critical("Creating AMI failed: %s", client_error)
+        try:
+            yield
+        finally:
+            # Anything create_ami did not handle itself must neither replace
+            # the backup's result nor hide an exception leaving the block
+            try:
+                ami_future.result()
+            except Exception as ami_error:
+                logging.warning("Creating AMI failed: %s", ami_error)
+
+
+# --------------------------------------------------
+def finish_backup(copy_success, s3_bucket, topic_arn, expired_listing=None):
+    """Reports a failed backup via SNS or prunes old backups after a
+    successful one.
+
+    Args:
+        copy_success (bool): Whether the backup was sent successfully.
+        s3_bucket (str): The name of the S3 bucket holding the backups.
+        topic_arn (str): The SNS topic ARN to report failures to.
+        expired_listing (Future): The running list_expired_backups call,
+            or None to not prune, e.g. when lifecycle rules expire backups.
+
+    Returns:
+        bool: copy_success, passed through.
+    """
+
+    if not copy_success:
+        logging.warning("Sending backup failed w/o an exception code.")
+        message = "BestCase backup failed"
+        subject = "BestCase backup failed"
+        try:
+            send_msg_sns(message, topic_arn, subject=subject)
+        except Exception as sns_error:
+            logging.warning("Sending message to SNS topic failed: %s", sns_error)
         return False
-    
+    logging.info("Backup sent successfully.")
+    if expired_listing is None:
+        return True
+    try:
+        prune_backups(
+            s3_bucket, days=RETENTION_DAYS, expired_keys=expired_listing.result()
+        )
+        logging.info("Old backups pruned successfully.")
+    except Exception as prune_error:
+        logging.warning("Pruning backups failed: %s", prune_error)
+    return True
+
+
+# --------------------------------------------------
+def load_config(config_file, args):
+    """Reads the config file and resolves every optional setting.
+
+    Args:
+        config_file (file): The open JSON config file.
+        args (argparse.Namespace): The command-line arguments.
+
+    Returns:
+        dict: The config file's settings on top of the defaults.
+    """
+
+    settings = {**DEFAULT_SETTINGS, "compressor": args.compressor}
+    settings.update(json.load(config_file))
+    return settings
+
 
 # --------------------------------------------------
 def main():
@@ -335,12 +1395,17 @@ def main():
 
     # Use config file if provided, else use command line arguments
     if config_file is not None:
-        config = json.load(config_file)
+        config = load_config(config_file, args)
         directory_path = config["best_case_dir"]
         s3_bucket = config["s3_bucket"]
         debug = config["debug_mode"]
-        use_boto3 = config["use_boto3"]
         topic_arn = config["topic_arn"]
+        stream_upload = config["stream_upload"]
+        compressor = config["compressor"]
+        shard_clients = config["shard_clients"]
+        lifecycle_expiration = config["lifecycle_expiration"]
+        compression_level = config["compression_level"]
+        storage_class = config["storage_class"]
     else:
         logging.critical("No config file provided, exiting.")
         return False
@@ -352,81 +1417,129 @@ def main():
         return False
 
     # Define location of log file
-    log_file = tempfile.gettempdir() + "\\BestCaseBackup"
-
-    # if log file is too big, delete it
-    if os.path.exists(log_file):
-        if os.path.getsize(log_file) > 1000000:
-            os.remove(log_file)
-
-    # Set logging level and start logging
-    if debug:
-        logging.basicConfig(
-            filename=log_file,
-            encoding="utf-8",
-            format="%(asctime)s %(levelname)s: %(message)s",
-            level=logging.DEBUG,
-        )
-    else:
-        logging.basicConfig(
-            filename=log_file,
-            encoding="utf-8",
-            format="%(asctime)s %(levelname)s: %(message)s",
-            level=logging.INFO,
-        )
+    log_file = str(TEMP_DIR / "BestCaseBackup")
+
+    # Set logging level and start logging; the handler keeps the log open
+    # for the whole run and rolls it over once it grows past LOG_MAX_BYTES
+    logging.basicConfig(
+        handlers=[
+            RotatingFileHandler(
+                log_file,
+                maxBytes=LOG_MAX_BYTES,
+                backupCount=LOG_BACKUP_COUNT,
+                encoding="utf-8",
+            )
+        ],
+        format="%(asctime)s %(levelname)s: %(message)s",
+        level=logging.DEBUG if debug else logging.INFO,
+    )
     logging.info("Log started at %s", datetime.datetime.now())
+
+    if compressor != "zip" and not os.path.isabs(find_7z()):
+        logging.critical("7z is not installed, exiting.")
+        return False
+
+    if compressor not in COMPRESSORS:
+        logging.critical("Unknown compressor '%s', exiting.", compressor)
+        return False
+
+    max_level = COMPRESSORS[compressor]["max_level"]
+    if compression_level is not None and (
+        not isinstance(compression_level, int)
+        or isinstance(compression_level, bool)  # JSON true/false are ints too
+        or not 0 <= compression_level <= max_level
+    ):
+        logging.critical("Compression level must be 0 to %d, exiting.", max_level)
+        return False
+
+    if storage_class not in STORAGE_CLASSES:
+        logging.critical("Unknown storage class '%s', exiting.", storage_class)
+        return False
+
+    # Let S3 expire old backups instead of listing and pruning them
+    if lifecycle_expiration and not ensure_lifecycle_rules(
+        s3_bucket, days=RETENTION_DAYS
+    ):
+        logging.warning("Falling back to pruning old backups.")
+        lifecycle_expiration = False
     
     # Compress the BestCase CLIENTS directory
     logging.info("Compressing directory: %s", directory_path)
     
     # close all BestCase processes
     close_processes_by_name('WinBFS.EXE')
-    [compress_success, output_file] = compress_dir_7z(directory_path, output_file=None)
 
-    if not compress_success:
-        logging.error("Compression failed, exiting now.")
-        return False
+    # On Sundays snapshot the instance while the backup runs; BestCase is
+    # closed by now, so its files are consistent
+    sunday = datetime.date.today().weekday() == 6
+    with ami_alongside(sunday), ThreadPoolExecutor(max_workers=2) as executor:
+        # Look up the expired backups while this one is made; they are only
+        # deleted once it has been sent
+        expired_listing = None
+        if not lifecycle_expiration:
+            get_s3_client()  # Create the shared client before the worker uses it
+            expired_listing = executor.submit(
+                list_expired_backups, s3_bucket, days=RETENTION_DAYS
+            )
 
-    logging.info("Compressed file: %s", output_file)
+        # Back up each client folder separately
+        if shard_clients:
+            copy_success = send_shards(
+                directory_path,
+                s3_bucket,
+                compressor,
+                compression_level,
+                storage_class,
+            )
+            if copy_success is not None:
+                return finish_backup(
+                    copy_success, s3_bucket, topic_arn, expired_listing
+                )
 
-    # Send the backup to the S3 bucket
-    try:
-        copy_success = send_backup(output_file, s3_bucket, use_boto3)
-        if not copy_success:
-            logging.warning("Sending backup failed w/o an exception code.")
-            message = "BestCase backup failed"
-            subject = "BestCase backup failed"
-            try:
-                send_msg_sns(message, topic_arn, use_boto=True, subject=subject)
-            except Exception as sns_error:
-                logging.warning("Sending message to SNS topic failed: %s", sns_error)
+        # Stream the archive straight into S3, skipping the temporary file
+        if stream_upload:
+            procs = stream_dir(directory_path, compressor, compression_level)
+            if procs is None:
+                logging.error("Compression failed, exiting now.")
+                return False
+            extension = COMPRESSORS[compressor]["stream_extension"]
+            copy_success = stream_backup(
+                procs, s3_bucket, archive_name(extension), storage_class
+            )
+            return finish_backup(copy_success, s3_bucket, topic_arn, expired_listing)
+
+        [compress_success, output_file] = compress_dir(
+            directory_path,
+            output_file=None,
+            compressor=compressor,
+            level=compression_level,
+        )
+
+        if not compress_success:
+            logging.error("Compression failed, exiting now.")
             return False
-        logging.info("Backup sent successfully.")
+
+        logging.info("Compressed file: %s", output_file)
+
+        # Send the backup to the S3 bucket, then drop the archive while pruning
+        from botocore.exceptions import BotoCoreError, ClientError
+
         try:
-            prune_backups(s3_bucket, days=7, use_boto=use_boto3)
-            logging.info("Old backups pruned successfully.")
-        except Exception as prune_error:
-            logging.warning("Pruning backups failed: %s", prune_error)
-        return True
-    except ClientError as send_error:
-        logging.critical("Sending backup failed: %s", send_error)
-        return False
-    finally:
-        logging.info("Removing compressed file: %s", output_file)
-        os.remove(output_file)
+            copy_success = send_backup(
+                output_file, s3_bucket, storage_class=storage_class
+            )
+        except (BotoCoreError, ClientError) as send_error:
+            logging.critical("Sending backup failed: %s", send_error)
+            return False
+        finally:
+            logging.info("Removing compressed file: %s", output_file)
+            executor.submit(remove_archive, output_file)
+        return finish_backup(copy_success, s3_bucket, topic_arn, expired_listing)
 
 
 # --------------------------------------------------
 if __name__ == "__main__":
-    start_time = datetime.datetime.now()
+    start_time = time.perf_counter()
     main()
-    end_time = datetime.datetime.now()
-    elapsed_time = end_time - start_time
-    logging.info("Elapsed time: %s", elapsed_time)
-    """ 
-    Create an AMI of the current EC2 instance if it's Sunday 
-    This will stop the instance, create the AMI, and then start the instance
-    hence the need to run this after the backup is complete
-    """
-    if datetime.date.today().weekday() == 6:
-        create_ami()
\ No newline at end of file
+    elapsed_time = datetime.timedelta(seconds=time.perf_counter() - start_time)
+    logging.info("Elapsed time: %s", elapsed_time)
\ No newline at end of file
@@ -7,33 +7,83 @@ Purpose: Create an AMI of the current EC2 instance
 
 import logging
 import datetime
-import boto3
-from botocore.exceptions import ClientError
-from pathlib import Path
-import requests
+import urllib.request
+from functools import lru_cache
+
+# Instance metadata service; an unreachable one fails fast instead of hanging
+IMDS_URL = "http://169.254.169.254/latest/"
+IMDS_TIMEOUT = 2
+
+
+# --------------------------------------------------
+@lru_cache(maxsize=None)
+def get_ec2_client(session=None):
+    """Returns the shared Boto3 EC2 client, created from session if given,
+    else from the default session"""
+
+    if session is None:
+        import boto3
+
+        return boto3.client("ec2")
+    return session.client("ec2")
 
 
 # --------------------------------------------------
-def create_ami():
-    """Create an AMI of the current EC2 instance"""
+@lru_cache(maxsize=None)
+def get_instance_id():
+    """Returns the ID of the current EC2 instance, asking the instance
+    metadata service (IMDSv2) once per run"""
+
+    token_request = urllib.request.Request(
+        IMDS_URL + "api/token",
+        method="PUT",
+        headers={"X-aws-ec2-metadata-token-ttl-seconds": "21600"},
+    )
+    with urllib.request.urlopen(token_request, timeout=IMDS_TIMEOUT) as response:
+        token = response.read().decode("ascii")
+
+    id_request = urllib.request.Request(
+        IMDS_URL + "meta-data/instance-id",
+        headers={"X-aws-ec2-metadata-token": token},
+    )
+    with urllib.request.urlopen(id_request, timeout=IMDS_TIMEOUT) as response:
+        return response.read().decode("ascii")
+
+
+# --------------------------------------------------
+def create_ami(no_reboot=False, ec2_client=None):
+    """Create an AMI of the current EC2 instance
+
+    Args:
+        no_reboot (bool): Whether to snapshot the running instance instead
+            of stopping it for a consistent image.
+        ec2_client: The Boto3 EC2 client to use, get_ec2_client() if None.
+
+    Returns:
+        bool: True if the AMI is being created, False otherwise.
+    """
+
+    from botocore.exceptions import ClientError
 
     try:
         today_date = datetime.date.today().isoformat()
-        instance_id = requests.get(
-            "http://169.254.169.254/latest/meta-data/instance-id").text
+        instance_id = get_instance_id()
         logging.info("Instance ID: %s", instance_id)
-        ec2_client = boto3.client("ec2")
-        response = ec2_client.create_image(
+        response = (ec2_client or get_ec2_client()).create_image(
             InstanceId=instance_id,
             Name="BestCaseInstance-" + today_date,
             Description="BestCaseInstance-" + today_date,
-            NoReboot=False,
+            NoReboot=no_reboot,
         )
-        logging.info("Response: %s", response)
+        logging.info("Creating AMI %s.", response["ImageId"])
+        logging.debug("Response: %s", response)
         return True
     except ClientError as client_error:
         logging.critical("Creating AMI failed: %s", client_error)
         return False
+    except OSError as os_error:
+        logging.critical("Reading the instance ID failed: %s", os_error)
+        return False
     
 if __name__ == "__main__":
     create_ami()
@@ -5,19 +5,263 @@ Date   : 2023-06-07
 Purpose: creates a config file
 """
 
+import argparse
+import hashlib
+import importlib
+import importlib.util
 import json
 import os
+import re
+import shutil
 import sys
 import subprocess
 import logging
+import time
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:  # Optional, the stdlib encoder is used instead
+    orjson = None
+
+# Where to send users for boto3 and AWS CLI help
+DOC_SITE = (
+    "https://boto3.amazonaws.com/v1/documentation/api/"
+    "latest/guide/quickstart.html#configuration"
+)
+WINDOWS_DOC_SITE = (
+    "https://docs.aws.amazon.com/cli/latest/userguide/install-cliv2-windows.html"
+)
+
+# Remembers a passed AWS environment check, next to config.json
+SETUP_CACHE = ".setup_cache.json"
+SETUP_CACHE_MAX_AGE = 24 * 60 * 60
+
+# Environment variables that pick or hold the AWS credentials
+CREDENTIAL_VARIABLES = (
+    "AWS_PROFILE",
+    "AWS_DEFAULT_PROFILE",
+    "AWS_SHARED_CREDENTIALS_FILE",
+    "AWS_CONFIG_FILE",
+    "AWS_ACCESS_KEY_ID",
+    "AWS_SECRET_ACCESS_KEY",
+    "AWS_SESSION_TOKEN",
+    "AWS_ROLE_ARN",
+    "AWS_WEB_IDENTITY_TOKEN_FILE",
+)
+
+# Signs of credentials that can expire before the cache does: SSO,
+# assumed roles and credential processes
+TEMPORARY_CREDENTIAL_MARKERS = (
+    b"sso_",
+    b"role_arn",
+    b"credential_process",
+    b"web_identity_token_file",
+)
+
+# Answers to a prompt before setup gives up
+MAX_ATTEMPTS = 3
+
+# Answers taken as yes to a (Y/N) question, after stripping and lowercasing
+YES = frozenset({"y", "yes"})
+
+# S3 bucket naming rules: 3-63 lowercase letters, digits, dots and hyphens,
+# starting and ending with a letter or digit
+BUCKET_RE = re.compile(r"[a-z0-9][a-z0-9.\-]{1,61}[a-z0-9]")
+
+# SNS topic ARNs in any partition: region, 12-digit account and a topic name
+# of up to 256 letters, digits, hyphens and underscores, .fifo for FIFO topics
+TOPIC_ARN_RE = re.compile(
+    r"arn:aws[a-z-]*:sns:[a-z0-9-]+:\d{12}:[A-Za-z0-9_-]{1,256}(\.fifo)?"
+)
 
 
 # --------------------------------------------------
-def test_whether_boto3_is_installed(doc_site):
-    """Test whether boto3 is installed"""
+def get_args():
+    """Get command-line arguments; any answer given here is not prompted for"""
+
+    parser = argparse.ArgumentParser(
+        description="Create the config file for the BestCase backup",
+        epilog=f"AWS configuration help: {DOC_SITE}",
+    )
+
+    parser.add_argument(
+        "--best-case-dir",
+        help="Where Best Case is installed, e.g. C:\\BestCase",
+        metavar="DIR",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--topic-arn",
+        help="ARN of the SNS topic to report failed backups to",
+        metavar="str",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--s3-bucket",
+        help="S3 bucket for the backups, e.g. s3://my-bestcase-backups",
+        metavar="str",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--create-bucket",
+        help="Create the S3 bucket instead of using an existing one",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--debug",
+        help="Run the backup in DEBUG mode",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "-y",
+        "--yes",
+        help="Do not ask yes/no questions: install boto3 if needed and use "
+        "the flags above for the rest",
+        action="store_true",
+    )
+
+    return parser.parse_args()
+
+
+# --------------------------------------------------
+@lru_cache(maxsize=None)
+def get_session():
+    """Create the boto3 session on first use; its clients share the
+    resolved credentials"""
+    import boto3
+
+    return boto3.session.Session()
+
+
+# --------------------------------------------------
+@lru_cache(maxsize=None)
+def get_client_config():
+    """Build the botocore Config shared by every client: short timeouts,
+    so setup fails fast when AWS is unreachable, and adaptive retries"""
+    from botocore.config import Config
+
+    return Config(
+        retries={"max_attempts": 3, "mode": "adaptive"},
+        max_pool_connections=10,
+        connect_timeout=3,
+        read_timeout=10,
+    )
+
+
+# --------------------------------------------------
+@lru_cache(maxsize=None)
+def get_s3_client():
+    """Create the S3 client on first use and reuse it for every check"""
+    return get_session().client("s3", config=get_client_config())
+
+
+# --------------------------------------------------
+def bucket_name(s3_bucket):
+    """Strip the s3:// scheme and any key prefix from an S3 URL"""
+    return s3_bucket.removeprefix("s3://").split("/", 1)[0]
+
+
+# --------------------------------------------------
+def test_bucket_name(s3_bucket):
+    """Test the S3 URL against the bucket naming rules before any request"""
+    if s3_bucket.startswith("s3://") and BUCKET_RE.fullmatch(bucket_name(s3_bucket)):
+        return True
+    logging.critical("ERROR: '%s' is not a valid S3 bucket URL", s3_bucket)
+    logging.warning("Please give a URL like s3://my-bestcase-backups")
+    return False
+
+
+# --------------------------------------------------
+def test_topic_arn(topic_arn):
+    """Test the SNS topic ARN's format; the backup only finds out a bad one
+    when a failed backup cannot be reported"""
+    if TOPIC_ARN_RE.fullmatch(topic_arn):
+        return True
+    logging.critical("ERROR: '%s' is not a valid SNS topic ARN", topic_arn)
+    logging.warning(
+        "Please give an ARN like arn:aws:sns:us-east-1:123456789012:my-topic"
+    )
+    return False
+
+
+# --------------------------------------------------
+def credentials_fingerprint():
+    """Hash the AWS credential sources, so a cached check goes stale when
+    they change; None for temporary credentials, which are never cached"""
+    if os.environ.get("AWS_SESSION_TOKEN") or os.environ.get("AWS_ROLE_ARN"):
+        return None
+    digest = hashlib.sha256()
+    for name in CREDENTIAL_VARIABLES:
+        digest.update(f"{name}={os.environ.get(name, '')}\n".encode("utf8"))
+    for variable, default in (
+        ("AWS_SHARED_CREDENTIALS_FILE", "~/.aws/credentials"),
+        ("AWS_CONFIG_FILE", "~/.aws/config"),
+    ):
+        try:
+            path = os.path.expanduser(os.environ.get(variable) or default)
+            with open(path, "rb") as file:
+                contents = file.read()
+        except OSError:
+            continue
+        if any(marker in contents for marker in TEMPORARY_CREDENTIAL_MARKERS):
+            return None
+        digest.update(contents)
+    return digest.hexdigest()[:16]
+
+
+# --------------------------------------------------
+def aws_environment_is_cached(use_boto3):
+    """Test whether the AWS environment passed its checks in the last day
+    with the same credentials"""
     try:
-        import boto3
-    except ImportError:
+        with open(SETUP_CACHE, encoding="utf8") as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return False
+    fingerprint = credentials_fingerprint()
+    return (
+        fingerprint is not None
+        and cache.get("fingerprint") == fingerprint
+        and cache.get("use_boto3") == use_boto3
+        and time.time() - cache.get("checked_at", 0) < SETUP_CACHE_MAX_AGE
+    )
+
+
+# --------------------------------------------------
+def cache_aws_environment(use_boto3):
+    """Remember that the AWS environment passed its checks"""
+    fingerprint = credentials_fingerprint()
+    if fingerprint is None:
+        logging.debug("Temporary AWS credentials, not caching the checks")
+        return
+    cache = {
+        "fingerprint": fingerprint,
+        "use_boto3": use_boto3,
+        "checked_at": time.time(),
+    }
+    with open(SETUP_CACHE, "w", encoding="utf8") as file:
+        json.dump(cache, file, indent=4)
+
+
+# --------------------------------------------------
+def clear_setup_cache():
+    """Forget a passed AWS environment check after any AWS failure"""
+    try:
+        os.remove(SETUP_CACHE)
+    except FileNotFoundError:
+        pass
+
+
+# --------------------------------------------------
+def test_whether_boto3_is_installed(doc_site):
+    """Test whether boto3 is installed, without importing it"""
+    if importlib.util.find_spec("boto3") is None:
         logging.warning("ERROR: boto3 is not installed")
         logging.warning("Please see %s for installation instructions", doc_site)
 
@@ -31,7 +275,17 @@ def install_boto3():
     """Install boto3"""
     try:
         subprocess.run(
-            ["pip", "install", "boto3"],
+            # This interpreter's pip, without its self-update check
+            [
+                sys.executable,
+                "-m",
+                "pip",
+                "install",
+                "--disable-pip-version-check",
+                "--no-input",
+                "--quiet",
+                "boto3",
+            ],
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
             check=True,
@@ -42,22 +296,17 @@ def install_boto3():
         logging.warning("Please install boto3 manually")
         return False
 
+    importlib.invalidate_caches()  # Let this process import the new package
     return True  # boto3 was installed
 
 
 # --------------------------------------------------
 def test_aws_cli_is_installed():
     """Test whether AWS CLI executable is installed and in my PATH"""
-    try:
-        subprocess.run(
-            ["aws", "--version"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            check=True,
-        )
-    except subprocess.CalledProcessError as called_error:
-        logging.warning("ERROR: AWS CLI is not installed")
-        logging.warning("ERROR: %s", called_error)
+    # A PATH lookup, instead of starting the CLI's bundled interpreter
+    if shutil.which("aws") is None:
+        # Only an error without boto3, which main reports
+        logging.debug("AWS CLI is not on the PATH")
         return False
 
     return True
@@ -83,15 +332,50 @@ def test_aws_cli_is_configured(doc_site):
     return True
 
 
+# --------------------------------------------------
+def validate_aws_environment(doc_site):
+    """Test the AWS credentials in the boto3 session, without the AWS CLI
+
+    Returns the caller's ARN, None if the credentials do not work.
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    # Resolving the session and credentials raises BotoCoreErrors too,
+    # e.g. for a mistyped AWS_PROFILE or a failing credential_process
+    try:
+        session = get_session()
+        # Finding no credentials at all needs no request, so skip STS for it
+        if session.get_credentials() is None:
+            logging.warning("ERROR: AWS credentials are not configured")
+            logging.warning("Please see %s for configuration instructions", doc_site)
+            return None
+        sts_client = session.client("sts", config=get_client_config())
+        identity = sts_client.get_caller_identity()
+    except (BotoCoreError, ClientError) as aws_error:
+        logging.warning("ERROR: AWS credentials are not configured")
+        logging.warning("ERROR: %s", aws_error)
+        logging.warning("Please see %s for configuration instructions", doc_site)
+        return None
+    logging.info("Using AWS identity %s", identity["Arn"])
+    return identity["Arn"]
+
+
 # --------------------------------------------------
 def test_best_case_dir(best_case_dir):
     """Test if the Best Case directory exists"""
-    if not os.path.isdir(best_case_dir):
+    # One directory read answers both checks, DirEntry caches its type
+    try:
+        with os.scandir(best_case_dir) as entries:
+            has_clients = any(
+                entry.name.upper() == "CLIENTS" and entry.is_dir()
+                for entry in entries
+            )
+    except OSError:  # Missing, not a directory or unreadable
         logging.critical("ERROR: '%s' is not a directory", best_case_dir)
         logging.warning("Please check your Best Case directory and try again")
         return False
-    clients_dir = os.path.join(best_case_dir, "CLIENTS")
-    if not os.path.isdir(clients_dir):
+    if not has_clients:
+        clients_dir = os.path.join(best_case_dir, "CLIENTS")
         logging.critical("ERROR: '%s' is not a directory", clients_dir)
         logging.warning("Please check your Best Case directory and try again")
         return False
@@ -99,8 +383,27 @@ def test_best_case_dir(best_case_dir):
 
 
 # --------------------------------------------------
-def new_s3_bucket(s3_bucket):
+def new_s3_bucket(s3_bucket, use_boto3=True):
     """Prompt user to create a new S3 bucket"""
+    if use_boto3:
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        s3_client = get_s3_client()
+        region = s3_client.meta.region_name
+        # us-east-1 is the default and must not be named as a location
+        bucket_config = {}
+        if region and region != "us-east-1":
+            bucket_config["CreateBucketConfiguration"] = {"LocationConstraint": region}
+        try:
+            s3_client.create_bucket(Bucket=bucket_name(s3_bucket), **bucket_config)
+        except (BotoCoreError, ClientError) as aws_error:
+            logging.warning("ERROR: AWS S3 bucket '%s' could not be created", s3_bucket)
+            logging.warning("ERROR: %s", aws_error)
+            clear_setup_cache()
+            logging.warning("Please choose a different name for your S3 bucket")
+            return False
+        return True
+
     try:
         subprocess.run(
             ["aws", "s3", "mb", s3_bucket],
@@ -111,6 +414,7 @@ def new_s3_bucket(s3_bucket):
     except subprocess.CalledProcessError as called_error:
         logging.warning("ERROR: AWS S3 bucket '%s' could not be created", s3_bucket)
         logging.warning("ERROR: %s", called_error)
+        clear_setup_cache()
         logging.warning("Please choose a different name for your S3 bucket")
         return False
 
@@ -118,19 +422,53 @@ def new_s3_bucket(s3_bucket):
 
 
 # --------------------------------------------------
-def test_s3_bucket(s3_bucket):
+def test_s3_bucket(s3_bucket, use_boto3=True):
     """Test if the S3 bucket exists or create S3 bucket"""
+    # A HEAD on the bucket answers without listing any of its keys. A 403
+    # still means the bucket exists, these credentials just cannot see it
+    if use_boto3:
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        try:
+            get_s3_client().head_bucket(Bucket=bucket_name(s3_bucket))
+        except ClientError as aws_error:
+            if aws_error.response.get("Error", {}).get("Code") == "403":
+                logging.warning(
+                    "AWS S3 bucket '%s' exists but is not accessible", s3_bucket
+                )
+                return True
+            logging.warning("ERROR: AWS S3 bucket '%s' does not exist", s3_bucket)
+            logging.warning("ERROR: %s", aws_error)
+            clear_setup_cache()
+            logging.warning(
+                "Please create the S3 bucket or specify a different S3 bucket"
+            )
+            return False
+        except BotoCoreError as aws_error:
+            logging.warning("ERROR: AWS S3 bucket '%s' could not be checked", s3_bucket)
+            logging.warning("ERROR: %s", aws_error)
+            clear_setup_cache()
+            return False
+        return True
+
     try:
-        # call subprocess but don't capture output
+        # call subprocess, keeping only stderr to tell 403 from 404
         subprocess.run(
-            ["aws", "s3", "ls", s3_bucket],
+            ["aws", "s3api", "head-bucket", "--bucket", bucket_name(s3_bucket)],
             stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
             check=True,
         )
     except subprocess.CalledProcessError as called_error:
+        if "(403)" in (called_error.stderr or ""):
+            logging.warning(
+                "AWS S3 bucket '%s' exists but is not accessible", s3_bucket
+            )
+            return True
         logging.warning("ERROR: AWS S3 bucket '%s' does not exist", s3_bucket)
         logging.warning("ERROR: %s", called_error)
+        clear_setup_cache()
         logging.warning("Please create the S3 bucket or specify a different S3 bucket")
         return False
 
@@ -138,52 +476,128 @@ def test_s3_bucket(s3_bucket):
 
 
 # --------------------------------------------------
-def create_config_file(use_boto3):
+def read_answer(question):
+    """Read one stripped answer from stdin, None once it runs out, e.g. at
+    the end of a piped answers file"""
+    try:
+        return input(question).strip()
+    except EOFError:
+        return None
+    except KeyboardInterrupt:
+        raise SystemExit("\nERROR: Setup cancelled") from None
+
+
+# --------------------------------------------------
+def ask(question, answer=None, flag=None):
+    """Return the answer given on the command line, else prompt for it"""
+    if answer is not None:
+        return answer
+    answer = read_answer(question)
+    if answer is None:
+        raise SystemExit(f"ERROR: No answer given, pass {flag} instead")
+    return answer
+
+
+# --------------------------------------------------
+def ask_yes_no(question, answer, args):
+    """Return answer when yes/no questions are skipped with --yes or stdin
+    runs out, else ask question"""
+    if args.yes:
+        return answer
+    reply = read_answer(question)
+    if reply is None:
+        return answer
+    return reply.lower() in YES
+
+
+# --------------------------------------------------
+def prompt_until_valid(question, is_valid, failure, answer=None, flag=None):
+    """Ask question until is_valid accepts the answer, exiting with failure
+    after MAX_ATTEMPTS tries. An answer given on the command line is only
+    tested once."""
+    if answer is not None:
+        if is_valid(answer):
+            return answer
+        raise SystemExit(f"ERROR: {failure}")
+    for _ in range(MAX_ATTEMPTS):
+        answer = ask(question, flag=flag)
+        if is_valid(answer):
+            return answer
+    raise SystemExit(f"ERROR: {failure}")
+
+
+# --------------------------------------------------
+def create_config_file(use_boto3, args):
     """Create the config file"""
     config = {}
 
     # Prompt for Best Case installation directory
-    best_case_dir_exists = False
-    while not best_case_dir_exists:
-        best_case_dir = input("Where is Best Case installed? E.g. C:\\BestCase: ")
-        best_case_dir_exists = test_best_case_dir(best_case_dir)
-    config["best_case_dir"] = best_case_dir
+    config["best_case_dir"] = prompt_until_valid(
+        "Where is Best Case installed? E.g. C:\\BestCase: ",
+        test_best_case_dir,
+        "No valid Best Case directory given",
+        answer=args.best_case_dir,
+        flag="--best-case-dir",
+    )
 
     # Prompt for AWS S3 bucket for backups
-    test_s3_bucket_exists = False
-    s3_bucket_defined = False
-    topic_arn = input("What is the ARN of the SNS topic to use? E.g. arn:aws:sns:us-east-1:123456789012:my-topic: ")
-    config["topic_arn"] = topic_arn
-
-    while not s3_bucket_defined:
-        do_create_s3_bucket = input(
-            "Do you want to create an AWS S3 bucket for backups? (Y/N): "
-        )
-        if do_create_s3_bucket.lower() == "y":
-            s3_bucket = input(
-                "What do you want to call the AWS S3 bucket? E.g. s3://my-bestcase-backups: "
-            )
-            s3_bucket_defined = new_s3_bucket(s3_bucket)
-        else:
-            while not test_s3_bucket_exists:
-                s3_bucket = input(
-                    "What S3 bucket will you use to store your backups? E.g. s3://my-bc-backups: "
-                )
-                test_s3_bucket_exists = test_s3_bucket(s3_bucket)
-            s3_bucket_defined = True
+    config["topic_arn"] = prompt_until_valid(
+        "What is the ARN of the SNS topic to use? E.g. arn:aws:sns:us-east-1:123456789012:my-topic: ",
+        test_topic_arn,
+        "No valid SNS topic ARN given",
+        answer=args.topic_arn,
+        flag="--topic-arn",
+    )
 
-    config["s3_bucket"] = s3_bucket
+    # Decide once whether to create or reuse a bucket, then ask only for it
+    if args.s3_bucket is not None:
+        do_create_s3_bucket = args.create_bucket
+    else:
+        do_create_s3_bucket = ask_yes_no(
+            "Do you want to create an AWS S3 bucket for backups? (Y/N): ",
+            args.create_bucket,
+            args,
+        )
+    if do_create_s3_bucket:
+        config["s3_bucket"] = prompt_until_valid(
+            "What do you want to call the AWS S3 bucket? E.g. s3://my-bestcase-backups: ",
+            lambda s3_bucket: test_bucket_name(s3_bucket)
+            and new_s3_bucket(s3_bucket, use_boto3),
+            "No S3 bucket could be created",
+            answer=args.s3_bucket,
+            flag="--s3-bucket",
+        )
+    else:
+        config["s3_bucket"] = prompt_until_valid(
+            "What S3 bucket will you use to store your backups? E.g. s3://my-bc-backups: ",
+            lambda s3_bucket: test_bucket_name(s3_bucket)
+            and test_s3_bucket(s3_bucket, use_boto3),
+            "No existing S3 bucket given",
+            answer=args.s3_bucket,
+            flag="--s3-bucket",
+        )
 
     # Prompt for DEBUG mode
-    debug_mode = input("Do you want to run the script in DEBUG mode? (Y/N): ")
-    config["debug_mode"] = debug_mode.lower() == "y"
+    config["debug_mode"] = args.debug or ask_yes_no(
+        "Do you want to run the script in DEBUG mode? (Y/N): ", False, args
+    )
 
     # Save use_bot3 to config file
     config["use_boto3"] = use_boto3
 
     # Save configuration to JSON file
-    with open("config.json", "w", encoding="utf8") as file:
-        json.dump(config, file, indent=4)
+    # Kept indented: users add the optional settings by hand. Written to a
+    # temporary file and renamed over config.json, so an interrupted setup
+    # never leaves a truncated config behind for the backup to read
+    tmp_config = "config.json.tmp"
+    with open(tmp_config, "w", encoding="utf8") as file:
+        if orjson is not None:
+            file.write(orjson.dumps(config, option=orjson.OPT_INDENT_2).decode("utf8"))
+        else:
+            json.dump(config, file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_config, "config.json")
 
     logging.info("Config file created successfully.")
 
@@ -191,23 +605,29 @@ def create_config_file(use_boto3):
 # --------------------------------------------------
 def main():
     """Make a jazz noise here"""
-    doc_site = (
-        "https://boto3.amazonaws.com/v1/documentation/api/" +
-        "latest/guide/quickstart.html#configuration"
-    )
-    windows_doc_site = (
-        "https://docs.aws.amazon.com/cli/latest/userguide/install-cliv2-windows.html"
-    )
+    # Configure logging before anything else runs, so every record setup
+    # writes goes through this one format
     logging.basicConfig(format="%(levelname)s - %(message)s", level=logging.INFO)
+    args = get_args()
 
-    if not test_whether_boto3_is_installed(doc_site):
+    # Both install probes are lookups, neither starts a process; the CLI
+    # only matters without boto3
+    boto3_installed = test_whether_boto3_is_installed(DOC_SITE)
+    aws_cli_installed = test_aws_cli_is_installed()
+
+    if not boto3_installed:
         logging.info("INFO: boto3 is not installed")
-        input("Press Enter to install boto3")
+        if not args.yes:
+            read_answer("Press Enter to install boto3")
         if not install_boto3():
             logging.error("ERROR: boto3 could not be installed")
-            logging.error("ERROR: Please see %s for installation instructions", doc_site)
-            input("Do you want to continue without installing boto3? (Y/N): ")
-            if input.lower() == "y":
+            logging.error("ERROR: Please see %s for installation instructions", DOC_SITE)
+            continue_without_boto3 = ask_yes_no(
+                "Do you want to continue without installing boto3? (Y/N): ",
+                args.yes,
+                args,
+            )
+            if continue_without_boto3:
                 use_boto3 = False
             else:
                 logging.critical("ERROR: Will not continue without boto3")
@@ -216,18 +636,30 @@ def main():
             use_boto3 = True
     else:
         use_boto3 = True
-    if not test_aws_cli_is_installed():
-        logging.error("ERROR: AWS CLI is not installed and boto3 is not installed")
-        logging.error(
-            "ERROR: Please install AWS CLI. See %s for instructions.", windows_doc_site
-        )
-        sys.exit(1)
-    if not test_aws_cli_is_configured(doc_site):
-        logging.error("ERROR: AWS CLI is not configured")
-        logging.error("ERROR: Please run 'aws configure' to configure AWS CLI")
-        sys.exit(1)
+    if aws_environment_is_cached(use_boto3):
+        logging.info("INFO: AWS environment was checked recently, skipping checks")
+    elif use_boto3:
+        # The SDK needs neither the AWS CLI nor its configure step
+        if validate_aws_environment(DOC_SITE) is None:
+            logging.error("ERROR: AWS credentials are not configured")
+            logging.error("ERROR: Please run 'aws configure' or set AWS_PROFILE")
+            sys.exit(1)
+        cache_aws_environment(use_boto3)
+    else:
+        if not aws_cli_installed:
+            logging.error("ERROR: AWS CLI is not installed and boto3 is not installed")
+            logging.error(
+                "ERROR: Please install AWS CLI. See %s for instructions.",
+                WINDOWS_DOC_SITE,
+            )
+            sys.exit(1)
+        if not test_aws_cli_is_configured(DOC_SITE):
+            logging.error("ERROR: AWS CLI is not configured")
+            logging.error("ERROR: Please run 'aws configure' to configure AWS CLI")
+            sys.exit(1)
+        cache_aws_environment(use_boto3)
     # Create the config file
-    create_config_file(use_boto3)
+    create_config_file(use_boto3, args)
 
 
 # --------------------------------------------------